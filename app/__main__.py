@@ -2,23 +2,38 @@
 from datetime import datetime
 from os import mkdir
 from aiohttp import web
-from jinja2 import Environment, FileSystemLoader, select_autoescape
+from sqlalchemy.orm import Session
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, select_autoescape
 import json
 from uuid import UUID
 import logging
+import asyncio
 import sys
 import re
 
-from elections import Backend, ElectionType
+from elections import Backend, ElectionType, NotFoundException
+from pages import BallotPageCache
 
 """
 jinja stuff
 """
+try:
+    mkdir('.jinja_cache')
+except FileExistsError:
+    pass
+
 jinja_env = Environment(
     loader=FileSystemLoader('templates'),
-    autoescape=select_autoescape()
+    autoescape=select_autoescape(),
+    bytecode_cache=FileSystemBytecodeCache('.jinja_cache')
 )
 
+# the ballot pages get hit once per voter so compile them ahead of time
+for template_name in ('ballot.html', 'voted.html', 'closed.html'):
+    jinja_env.get_template(template_name)
+
+page_cache = BallotPageCache(jinja_env)
+
 """
 logging stuff
 """
@@ -89,14 +104,24 @@ async def register(request):
 @routes.get('/ballots/{endpoint:[A-Za-z0-9_-]{107}}')
 async def get_ballot(request):
     endpoint = request.match_info["endpoint"]
-    ballot = backend.get_ballot_from_endpoint(endpoint)
-    template = jinja_env.get_template(('ballot.html' if not ballot.voted else 'voted.html') if not ballot.election.closed else 'closed.html')
-    return web.Response(text=template.render(ballot=ballot), content_type="HTML")
+    try:
+        ballot = backend.get_ballot_from_endpoint(endpoint)
+    except NotFoundException:
+        # the ballots of archived elections only exist in the archive, and those elections are always closed
+        try:
+            backend.get_archived_election_from_endpoint(endpoint)
+        except NotFoundException:
+            raise web.HTTPNotFound()
+        return web.Response(text=page_cache.render_closed(), content_type="HTML")
+    return web.Response(text=page_cache.render(ballot), content_type="HTML")
 
 @routes.post('/ballots/{endpoint:[A-Za-z0-9_-]{107}}/vote')
 async def vote(request):
     endpoint = request.match_info["endpoint"]
-    ballot = backend.get_ballot_from_endpoint(endpoint)
+    try:
+        ballot = backend.get_ballot_from_endpoint(endpoint)
+    except NotFoundException:
+        raise web.HTTPNotFound()
     data = await request.json()
     try:
         ballot.vote(data)
@@ -163,10 +188,32 @@ async def close_election(request):
         raise web.HTTPNotFound()
     if election.owner != request["account"]:
         raise web.HTTPUnauthorized()
-    election.closed = True
-    backend.session.commit()
+    backend.close_election(election)
     raise web.HTTPOk()
 
+ARCHIVE_INTERVAL = 3600
+
+
+def archive_in_own_session():
+    # this runs in an executor thread and backend.session isn't thread safe, so it gets a session of its own
+    with Session(backend.engine) as session:
+        backend.archive_closed_elections(session)
+
+
+async def archive_closed_elections(app):
+    async def run():
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, archive_in_own_session)
+            except Exception:
+                logger.exception('Failed to archive closed elections')
+            await asyncio.sleep(ARCHIVE_INTERVAL)
+
+    task = asyncio.create_task(run())
+    yield
+    task.cancel()
+
 @web.middleware
 async def request_logger(request: web.Request, handler):
     logger.info(f'{request.remote} {request.method} {request.url}')
@@ -192,8 +239,18 @@ async def authenticate(request: web.Request, handler):
     
 
 if __name__ == '__main__':
+    backend = Backend(**json.load(open("config.json")))
+    backend.close_listeners.append(page_cache.invalidate)
+    if sys.argv[1:] == ['migrate']:
+        # one off upgrade of a database created by an older version, run it before starting the server
+        backend.migrate()
+        sys.exit(0)
+    if sys.argv[1:] == ['archive']:
+        # one off archival run, e.g. from cron, instead of starting the web server
+        backend.archive_closed_elections()
+        sys.exit(0)
     app = web.Application(middlewares=[request_logger, authenticate])
     app.add_routes(routes)
-    backend = Backend(**json.load(open("config.json")))
+    app.cleanup_ctx.append(archive_closed_elections)
     web.run_app(app, port=8000)
 
@@ -0,0 +1,120 @@
+import gzip
+import json
+import os
+import struct
+from uuid import UUID
+
+
+class BallotArchive(object):
+    """
+    Append-only cold storage for the ballots of closed elections.
+
+    Each election gets a single gzipped JSON file laid out column by column, so it can be read back
+    offline with nothing but gzip and a JSON parser. Archive files are written once and never modified.
+
+    Alongside them ballots.idx maps every archived ballot uuid to its election, as packed 16 byte uuid pairs,
+    so old ballot links can still be resolved without opening every archive.
+    """
+    VERSION = 1
+    COLUMNS = ('uuid', 'created_at', 'salt_uuid', 'voted', 'data')
+    INDEX_FILE = 'ballots.idx'
+    INDEX_RECORD = struct.Struct('16s16s')
+
+    def __init__(self, directory='archive'):
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.index = {}
+        self.index_size = 0
+
+    def path_for(self, election_id: UUID):
+        return os.path.join(self.directory, f'{election_id}.json.gz')
+
+    def exists(self, election_id: UUID):
+        return os.path.exists(self.path_for(election_id))
+
+    def write(self, election, ballots):
+        columns = {column: [] for column in self.COLUMNS}
+        index_records = bytearray()
+        for ballot in ballots:
+            index_records += self.INDEX_RECORD.pack(ballot.uuid.bytes, election.id.bytes)
+            columns['uuid'].append(str(ballot.uuid))
+            columns['created_at'].append(ballot.created_at)
+            columns['salt_uuid'].append(str(ballot.salt_uuid))
+            columns['voted'].append(bool(ballot.voted))
+            columns['data'].append(ballot.data if ballot.voted else None)
+
+        archive = {
+            "version": self.VERSION,
+            "election": {
+                "id": str(election.id),
+                "name": election.name,
+                "election_type": election.election_type.name,
+                "candidates": election.candidates,
+                "available_seats": election.available_seats,
+                "closed_at": election.closed_at,
+            },
+            "columns": columns,
+        }
+
+        num_ballots = len(columns['uuid'])
+        num_ballots_cast = columns['voted'].count(True)
+
+        # write everything out to a temporary file first and then link it into place,
+        # that way a half written archive can never be mistaken for a finished one and
+        # an existing archive can never be overwritten
+        path = self.path_for(election.id)
+        tmp_path = path + '.tmp'
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump(archive, f, separators=(',', ':'))
+        try:
+            # the index goes first, if the link never happens the next run just appends the same records again
+            self._append_index(index_records)
+            os.link(tmp_path, path)
+        finally:
+            os.remove(tmp_path)
+        return num_ballots, num_ballots_cast
+
+    def read(self, election_id: UUID):
+        with gzip.open(self.path_for(election_id), 'rt', encoding='utf-8') as f:
+            return json.load(f)
+
+    def find_election(self, ballot_uuid: UUID):
+        self._load_index()
+        election_id = self.index.get(ballot_uuid.bytes)
+        return None if election_id is None else UUID(bytes=election_id)
+
+    def find_ballot(self, election_id: UUID, ballot_uuid: UUID):
+        columns = self.read(election_id)["columns"]
+        try:
+            i = columns['uuid'].index(str(ballot_uuid))
+        except ValueError:
+            return None
+        return {column: columns[column][i] for column in self.COLUMNS}
+
+    def count(self, election_id: UUID):
+        voted = self.read(election_id)["columns"]['voted']
+        return len(voted), voted.count(True)
+
+    def read_votes(self, election_id: UUID):
+        columns = self.read(election_id)["columns"]
+        return [data for voted, data in zip(columns['voted'], columns['data']) if voted]
+
+    def _append_index(self, records):
+        with open(os.path.join(self.directory, self.INDEX_FILE), 'ab') as f:
+            # drop any partial record left behind by a write that died half way through
+            f.truncate(f.tell() - f.tell() % self.INDEX_RECORD.size)
+            f.write(records)
+
+    def _load_index(self):
+        # only reads whatever has been appended since the last call, the archiver may be another process
+        path = os.path.join(self.directory, self.INDEX_FILE)
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as f:
+            f.seek(self.index_size)
+            data = f.read()
+        data = data[:len(data) - len(data) % self.INDEX_RECORD.size]
+        for ballot_uuid, election_id in self.INDEX_RECORD.iter_unpack(data):
+            self.index[ballot_uuid] = election_id
+        self.index_size += len(data)
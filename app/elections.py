@@ -7,8 +7,8 @@ import smtplib
 from jwt import InvalidTokenError
 from sqlalchemy.exc import NoResultFound, MultipleResultsFound
 from sqlalchemy_utils import UUIDType
-from sqlalchemy import Column, String, Integer, JSON, ForeignKey, Boolean, TIMESTAMP
-from sqlalchemy.orm import Session, registry, relationship
+from sqlalchemy import Column, String, Integer, JSON, ForeignKey, Boolean, TIMESTAMP, Index
+from sqlalchemy.orm import Session, registry, relationship, joinedload
 from sqlalchemy.types import ARRAY, Enum as SQLEnum
 import datetime
 from passlib.hash import sha512_crypt
@@ -18,6 +18,7 @@ import hmac
 import jwt
 import os.path
 from emails import GmailClient
+from archive import BallotArchive
 from py3votecore.stv import STV
 
 logger = logging.getLogger(__name__)
@@ -74,22 +75,38 @@ class Election(Base):
     candidates = Column(JSON, server_default="[]")
     available_seats = Column(Integer)
     closed = Column(Boolean, default=False)
+    closed_at = Column(Integer(), nullable=True)
+    # once archived the ballots live in the BallotArchive instead of the ballots table, so keep the counts around
+    archived = Column(Boolean, default=False)
+    archived_num_ballots = Column(Integer(), nullable=True)
+    archived_num_ballots_cast = Column(Integer(), nullable=True)
     ballots = relationship("Ballot", back_populates='election')
 
     def __repr__(self):
         return f"<Election id={self.id}, name={self.name}, owner={self.owner.__repr__()}, election_type={self.election_type}>"
 
+    def get_num_ballots(self):
+        if self.archived:
+            return self.archived_num_ballots
+        return len(self.ballots)
+
     def get_num_ballots_cast(self):
+        if self.archived:
+            return self.archived_num_ballots_cast
         return len([ballot for ballot in self.ballots if ballot.voted])
 
     def get_percent_ballots_cast(self):
-        return round((self.get_num_ballots_cast()/len(self.ballots))*100, 2)
+        return round((self.get_num_ballots_cast()/self.get_num_ballots())*100, 2)
 
 class AlreadyVotedException(Exception):
     pass
 
 class Ballot(Base):
     __tablename__ = 'ballots'
+    __table_args__ = (
+        # covers the tally query in generate_results as well as plain lookups by election
+        Index('ix_ballots_election_id_voted', 'election_id', 'voted'),
+    )
     uuid = Column(UUIDType(), primary_key=True, default=uuid4)
     created_at = Column(Integer(), default=lambda: round(time()))
     election_id = Column(UUIDType, ForeignKey('elections.id'))
@@ -121,10 +138,15 @@ class Ballot(Base):
 
 
 class Backend(object):
-    def __init__(self, keypair, db_url='postgresql:///elections', email_client=None, url_prefix='http://localhost'):
+    def __init__(self, keypair, db_url='postgresql:///elections', email_client=None, url_prefix='http://localhost',
+                 archive_dir='archive', archive_retention=30*86400):
         self.priv_key = keypair[0]
         self.pub_key = keypair[1]
         self.url_prefix = url_prefix
+        self.archive = BallotArchive(archive_dir)
+        self.archive_retention = archive_retention
+        # callables that get passed the election whenever one is closed, e.g. to drop cached pages
+        self.close_listeners = []
         self.email_client = GmailClient() if email_client is None else email_client
         logger.debug('New Backend class initiated')
         logger.debug(f"Connecting to the database at: {db_url}")
@@ -155,13 +177,32 @@ class Backend(object):
             # but this is mitigated by the fact that the uuid by itself is not enough to get the hash
             # and the chances of stumbling on a valid UUID are minimal 
             uuid, hash = self._split_uuid_and_hash(urlsafe_b64decode(endpoint + '='))
-            ballot = self.session.query(Ballot).filter_by(uuid=uuid).one()
+            # pull in the bits of the election the ballot pages need in the same round trip
+            ballot = self.session.query(Ballot) \
+                .options(joinedload(Ballot.election).load_only(Election.name, Election.candidates, Election.closed)) \
+                .filter_by(uuid=uuid).one()
             if not self._verify_ballot(ballot, hash):
                 raise NotFoundException('The hash in the endpoint does not match the ballot hash')
         except NoResultFound:
             raise NotFoundException('The ballot was not found')
         return ballot
 
+    def get_archived_election_from_endpoint(self, endpoint):
+        """
+        Returns the election an archived ballot belonged to, once an election is archived its ballots are
+        no longer in the database so get_ballot_from_endpoint can't find them
+        """
+        uuid, hash = self._split_uuid_and_hash(urlsafe_b64decode(endpoint + '='))
+        election_id = self.archive.find_election(uuid)
+        archived = None if election_id is None else self.archive.find_ballot(election_id, uuid)
+        if archived is None:
+            raise NotFoundException('The ballot was not found')
+        # a throwaway Ballot that never gets added to the session, just so the hash can be checked the usual way
+        ballot = Ballot(uuid=uuid, created_at=archived['created_at'], salt_uuid=UUID(archived['salt_uuid']))
+        if not self._verify_ballot(ballot, hash):
+            raise NotFoundException('The hash in the endpoint does not match the ballot hash')
+        return self.get_election(election_id)
+
     def add_account(self, username, password):
         if self.get_account(username) is not None:
             raise AccountExistsException()
@@ -193,14 +234,84 @@ class Backend(object):
     def get_election(self, election_id):
         if not isinstance(election_id, UUID):
             election_id = UUID(election_id)
-        return self.session.query(Election).filter_by(id=election_id).one_or_none()
+        # the archiver may have changed the election from another session, so don't trust the identity map
+        return self.session.query(Election).populate_existing().filter_by(id=election_id).one_or_none()
 
     def get_elections(self, owner: Account):
         return self.session.query(Election).filter_by(owner_id = owner.id).all()
+
+    def migrate(self):
+        """
+        Brings a database created before elections could be archived up to date, create_all only creates missing
+        tables so the newer election columns and ballot indexes get added here. Elections that were already closed
+        never had their closing time recorded, so closed_at is set to now and they get archived once
+        archive_retention has passed
+        """
+        inspector = sqlalchemy.inspect(self.engine)
+        existing_columns = {column['name'] for column in inspector.get_columns(Election.__tablename__)}
+        existing_indexes = {index['name'] for index in inspector.get_indexes(Ballot.__tablename__)}
+        with self.engine.begin() as connection:
+            for column in Election.__table__.columns:
+                if column.name not in existing_columns:
+                    logger.info(f"Adding column {column.name} to {Election.__tablename__}")
+                    column_type = column.type.compile(dialect=self.engine.dialect)
+                    connection.execute(sqlalchemy.text(f'ALTER TABLE {Election.__tablename__} ADD COLUMN {column.name} {column_type}'))
+            for index in Ballot.__table__.indexes:
+                if index.name not in existing_indexes:
+                    logger.info(f"Creating index {index.name}")
+                    index.create(connection)
+            connection.execute(
+                sqlalchemy.update(Election)
+                .where(Election.closed.is_(True), Election.closed_at.is_(None))
+                .values(closed_at=round(time()))
+            )
+        self.session.expire_all()
+
+    def close_election(self, election: Election):
+        election.closed = True
+        election.closed_at = round(time())
+        self.session.commit()
+        for listener in self.close_listeners:
+            listener(election)
+
+    def archive_closed_elections(self, session=None):
+        """
+        Moves the ballots of every election that was closed more than archive_retention seconds ago
+        out of the ballots table and into the ballot archive, pass a session to run it outside of self.session
+        """
+        session = self.session if session is None else session
+        cutoff = round(time()) - self.archive_retention
+        elections = session.query(Election) \
+            .filter(Election.closed.is_(True), Election.archived.isnot(True), Election.closed_at <= cutoff) \
+            .all()
+        for election in elections:
+            self.archive_election(election, session)
+        return elections
+
+    def archive_election(self, election: Election, session=None):
+        session = self.session if session is None else session
+        # if a previous run died after writing the archive but before committing, the archive is already complete
+        if self.archive.exists(election.id):
+            num_ballots, num_ballots_cast = self.archive.count(election.id)
+        else:
+            # stream plain rows rather than loading every Ballot object of the election at once
+            ballots = session.query(Ballot.uuid, Ballot.created_at, Ballot.salt_uuid, Ballot.voted, Ballot.data) \
+                .filter_by(election_id=election.id) \
+                .yield_per(1000)
+            num_ballots, num_ballots_cast = self.archive.write(election, ballots)
+        logger.info(f"Archived {num_ballots} ballots for election {election.id}")
+        election.archived_num_ballots = num_ballots
+        election.archived_num_ballots_cast = num_ballots_cast
+        election.archived = True
+        session.query(Ballot).filter_by(election_id=election.id).delete(synchronize_session=False)
+        session.commit()
     
     def generate_results(self, election):
         if election.election_type == ElectionType.STV:
-            ballots = [{"count": 1, "ballot": ballot.data} for ballot in self.session.query(Ballot).filter_by(voted=True, election_id = election.id)]
+            if election.archived:
+                ballots = [{"count": 1, "ballot": data} for data in self.archive.read_votes(election.id)]
+            else:
+                ballots = [{"count": 1, "ballot": ballot.data} for ballot in self.session.query(Ballot).filter_by(voted=True, election_id = election.id)]
             if len(ballots) == 0:
                 return {
                         "candidates": election.candidates,
@@ -0,0 +1,42 @@
+from collections import OrderedDict
+
+
+class BallotPageCache(object):
+    """
+    A bounded LRU cache of rendered ballot pages.
+
+    voted.html and closed.html don't depend on the ballot at all and ballot.html only depends on the election,
+    so every page is keyed on (template, election_id) and rendered once until it's evicted or invalidated
+    """
+
+    def __init__(self, jinja_env, max_size=256):
+        self.jinja_env = jinja_env
+        self.max_size = max_size
+        self.pages = OrderedDict()
+
+    @staticmethod
+    def key_for(ballot):
+        if ballot.election.closed:
+            return 'closed.html', None
+        if ballot.voted:
+            return 'voted.html', None
+        return 'ballot.html', ballot.election_id
+
+    def render(self, ballot):
+        return self._render(self.key_for(ballot), ballot=ballot)
+
+    def render_closed(self):
+        return self._render(('closed.html', None))
+
+    def invalidate(self, election):
+        self.pages.pop(('ballot.html', election.id), None)
+
+    def _render(self, key, **context):
+        if key in self.pages:
+            self.pages.move_to_end(key)
+            return self.pages[key]
+        page = self.jinja_env.get_template(key[0]).render(**context)
+        self.pages[key] = page
+        if len(self.pages) > self.max_size:
+            self.pages.popitem(last=False)
+        return page
@@ -2,6 +2,7 @@
 
 import unittest
 from backend_tests import BackendTests
+from pages_tests import PagesTests
 
 
 if __name__ == '__main__':
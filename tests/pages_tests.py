@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+import unittest
+from os import path
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+# backend_tests adds the app directory to the path
+from backend_tests import new_backend, endpoint_from_email
+from elections import ElectionType
+from pages import BallotPageCache
+
+templates_dir = path.join(path.dirname(path.dirname(path.abspath(__file__))), 'templates')
+
+
+def new_page_cache(backend, max_size=256):
+    jinja_env = Environment(loader=FileSystemLoader(templates_dir), autoescape=select_autoescape())
+    page_cache = BallotPageCache(jinja_env, max_size=max_size)
+    backend.close_listeners.append(page_cache.invalidate)
+    return page_cache
+
+
+def create_election(backend, name="Test-Election", num_ballots=2):
+    if backend.get_account('bob') is None:
+        backend.add_account('bob', '12345')
+    backend.email_client.email_cache = []
+    election = backend.create_election(backend.get_account('bob'), name, ElectionType.STV, ["c1", "c2"], [f"email{i}@lwetb.ie" for i in range(num_ballots)])
+    return election, [endpoint_from_email(email) for email in backend.email_client.email_cache]
+
+
+class PagesTests(unittest.TestCase):
+    def test_ballot_page_cached_per_election(self):
+        backend = new_backend()
+        page_cache = new_page_cache(backend)
+        election, endpoints = create_election(backend)
+
+        page = page_cache.render(backend.get_ballot_from_endpoint(endpoints[0]))
+        self.assertIn('<li id="c1">c1</li>', page)
+        self.assertEqual(list(page_cache.pages), [('ballot.html', election.id)])
+        self.assertIs(page_cache.render(backend.get_ballot_from_endpoint(endpoints[1])), page)
+
+    def test_voted_page(self):
+        backend = new_backend()
+        page_cache = new_page_cache(backend)
+        election, endpoints = create_election(backend)
+
+        ballot = backend.get_ballot_from_endpoint(endpoints[0])
+        ballot.vote(["c2", "c1"])
+        backend.session.commit()
+        self.assertEqual(page_cache.key_for(ballot), ('voted.html', None))
+        self.assertIn('Successfully Voted', page_cache.render(ballot))
+
+    def test_closing_invalidates_ballot_page(self):
+        backend = new_backend()
+        page_cache = new_page_cache(backend)
+        election, endpoints = create_election(backend)
+
+        ballot = backend.get_ballot_from_endpoint(endpoints[0])
+        page_cache.render(ballot)
+        backend.close_election(election)
+        self.assertNotIn(('ballot.html', election.id), page_cache.pages)
+        self.assertIn('This Election has been closed', page_cache.render(ballot))
+
+    def test_cache_is_bounded(self):
+        backend = new_backend()
+        page_cache = new_page_cache(backend, max_size=1)
+        first_election, first_endpoints = create_election(backend, "First")
+        second_election, second_endpoints = create_election(backend, "Second")
+
+        page_cache.render(backend.get_ballot_from_endpoint(first_endpoints[0]))
+        page_cache.render(backend.get_ballot_from_endpoint(second_endpoints[0]))
+        self.assertEqual(list(page_cache.pages), [('ballot.html', second_election.id)])
+
+    def test_archived_election_panel(self):
+        backend = new_backend()
+        page_cache = new_page_cache(backend)
+        election, endpoints = create_election(backend)
+        backend.get_ballot_from_endpoint(endpoints[0]).vote(["c2", "c1"])
+        backend.close_election(election)
+        backend.archive_closed_elections()
+
+        template = page_cache.jinja_env.get_template('election.html')
+        page = template.render(election=election, results=backend.generate_results(election))
+        self.assertIn('1/2 50.0%', page)
+
+
+if __name__ == '__main__':
+    unittest.main()